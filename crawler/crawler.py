@@ -1,37 +1,187 @@
 # crawler/crawler.py
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup
+from urllib.robotparser import RobotFileParser
+from collections import deque
+from itertools import islice
+from selectolax.lexbor import LexborHTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import logging
 import hashlib
-import csv
+import html
+import re
+import multiprocessing
+import threading
 import sys
 
+try:
+    from blake3 import blake3
+except ImportError:     # Fall back to the standard library if blake3 is not installed
+    blake3 = None
+
+# Link schemes that can't be crawled
+SKIP_SCHEMES = frozenset({'javascript', 'mailto', 'tel', 'ftp', 'data', 'blob', 'about'})
+
+# Maximum number of concurrent requests to a single host, so no site is hit by every worker at once
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Matches the fragment identifier at the end of a URL
+FRAGMENT_RE = re.compile(r'#.*$')
+
+# Matches the href value of <a> tags (double-quoted, single-quoted or unquoted), used by the fast_parse mode
+HREF_PATTERN = r'''<a\b[^>]*?\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))'''
+HREF_RE = re.compile(HREF_PATTERN, re.IGNORECASE)
+HREF_BYTES_RE = re.compile(HREF_PATTERN.encode('ascii'), re.IGNORECASE)
+
+# Matches the charset declared by a <meta charset> or <meta http-equiv="Content-Type"> tag
+META_CHARSET_RE = re.compile(rb'''<meta\s[^>]*?charset\s*=\s*["']?\s*([\w:.-]+)''', re.IGNORECASE)
+
+# Forking while the fetch threads are running is unsafe, so the parse workers start from a fresh interpreter
+PARSE_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+
+def setup_logging():
+    """
+    Set up the logging configuration, in the main process and in each parse worker process.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+
+
+@lru_cache(maxsize=100_000)
+def parse_url(url):
+    """
+    Parse a URL, caching the result - the same links show up on many pages of a site.
+    :param url: The URL to parse.
+    :return: The urlparse result of the URL.
+    """
+    return urlparse(url)
+
+
+def quote_tsv_field(value):
+    """
+    Quote a TSV field the way csv's default QUOTE_MINIMAL does, if it contains a tab, a quote or a line break.
+    :param value: The field value.
+    :return: The field as written to the TSV file.
+    """
+    if any(char in value for char in '\t"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def content_digest(content):
+    """
+    Compute a 128-bit fingerprint of the page content, used to detect duplicate pages.
+    Deduplication doesn't need a cryptographic hash, so the fastest available one is used.
+    :param content: The raw page content.
+    :return: The 16-byte digest of the content as an int (smaller and faster to hash in a set than bytes).
+    """
+    if blake3 is not None:
+        digest = blake3(content).digest(length=16)
+    else:
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def find_hrefs(html_content):
+    """
+    Find the href values of all <a> tags with a regex over the raw HTML, without building a DOM.
+    Much faster than parsing, but less robust (e.g. it also matches tags inside comments and scripts).
+    :param html_content: The HTML content of the page (str or raw UTF-8 bytes).
+    :return: A list of the href values.
+    """
+    if isinstance(html_content, bytes):
+        # Exactly one of the three alternatives matches, and lastindex is its group
+        return [html.unescape(match[match.lastindex].decode('utf-8', errors='replace'))
+                for match in HREF_BYTES_RE.finditer(html_content)]
+    return [html.unescape(match[match.lastindex]) for match in HREF_RE.finditer(html_content)]
+
+
+def extract_links(html_content, base_url, fast_parse=False):
+    """
+    Extract all valid links from the HTML content, stripping fragment identifiers.
+    A module-level function so it can be run in the parse worker processes.
+    :param html_content: The HTML content of the page (str or raw bytes).
+    :param base_url: The base URL to resolve relative links.
+    :param fast_parse: Whether to find the links with a regex instead of parsing the HTML.
+    :return: A list of (absolute URL, hostname) tuples for the links extracted from the page.
+    """
+    hrefs = find_hrefs(html_content) if fast_parse else None
+    if not hrefs:
+        # Without fast_parse, or when the regex found nothing (e.g. unusual markup), parse the HTML
+        tree = LexborHTMLParser(html_content)
+        hrefs = [node.attributes['href'] or '' for node in tree.css('a[href]')]      # Valueless 'href' attributes come back as None
+    links = []
+    for href in hrefs:
+        href = href.strip()
+        if not href:
+            continue
+        scheme, sep, _ = href.partition(':')
+        if sep and scheme.lower() in SKIP_SCHEMES:      # Relative links like 'about' have no scheme
+            continue
+        try:
+            # Resolve relative links (inheriting the scheme of base_url) and remove fragment identifiers
+            full_url = FRAGMENT_RE.sub('', urljoin(base_url, href))
+            links.append((full_url, parse_url(full_url).hostname))       # Keep the hostname for calculate_ratio
+        except Exception as e:
+            logging.error(f"Invalid URL '{href}' found on page '{base_url}': {e}")
+            continue
+    return links
+
+
 class WebCrawler:
-    def __init__(self, root_url, max_depth):
+    def __init__(self, root_url, max_depth, max_workers=50, respect_robots=True, fast_parse=False, parse_workers=0):
         """
         Initialize the WebCrawler with the root URL and maximum depth.
         :param root_url: The root URL to start crawling from.
         :param max_depth: The maximum depth to crawl.
+        :param max_workers: The maximum number of pages fetched concurrently.
+        :param respect_robots: Whether to skip URLs disallowed by the robots.txt of their host.
+        :param fast_parse: Whether to extract links with a regex over the raw HTML instead of parsing it.
+        :param parse_workers: The number of worker processes to parse pages in, or 0 to parse in the current process.
+            The workers start a fresh interpreter that re-imports the main module, so scripts using them must guard
+            their entry point with `if __name__ == '__main__':`.
         """
         self.setup_logging()
+        self.session = requests.Session()       # Shared by all requests so connections are kept alive and reused
+        adapter = HTTPAdapter(
+            pool_connections=100,       # Number of hosts to keep connection pools for
+            pool_maxsize=MAX_CONNECTIONS_PER_HOST + 1,      # Connections kept alive per host - the per-host request cap, plus one for its robots.txt
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.headers['Accept'] = 'text/html'       # Only HTML pages are crawled
         self.root_url = self.fix_url(root_url)
         self.max_depth = max_depth
+        self.max_workers = max_workers
+        self.respect_robots = respect_robots
+        self.fast_parse = fast_parse
+        self.parse_workers = parse_workers
+        self.host_semaphores = {}       # {netloc: Semaphore} limiting the concurrent requests to each host
+        self.robots_parsers = {}        # {robots.txt URL: RobotFileParser}, so each robots.txt is fetched once
+        self.robots_locks = {}          # {robots.txt URL: Lock}, so workers don't fetch the same robots.txt together
         self.visited_urls = set()
         self.visited_hashes = set()
-        self.results = []
+        self.results = {}       # {url: {'url': url, 'depth': depth, 'ratio': ratio}}, so each URL appears exactly once
         # self.setup_logging()
 
     def setup_logging(self):
         """
         Set up the logging configuration for the crawler.
         """
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s [%(levelname)s] %(message)s',
-            handlers=[logging.StreamHandler(sys.stdout)]
-        )
+        setup_logging()
 
     def fix_url(self, url):
         """
@@ -40,7 +190,7 @@ class WebCrawler:
         :param url: The URL to fix.
         :return: The URL with the correct scheme.
         """
-        parsed = urlparse(url)          # Parse the URL into 6 components <scheme>://<netloc>/<path>;<params>?<query>#<fragment>
+        parsed = parse_url(url)          # Parse the URL into 6 components <scheme>://<netloc>/<path>;<params>?<query>#<fragment>
         if not parsed.scheme:
             url_variants = [
                 'http://' + url,
@@ -50,7 +200,7 @@ class WebCrawler:
             ]
             for full_url in url_variants:
                 try:
-                    response = requests.head(full_url, timeout=3)
+                    response = self.session.head(full_url, timeout=3, allow_redirects=False)
                     if response.status_code < 400:
                         logging.info(f"No scheme provided. Using URL: {full_url}")
                         return full_url
@@ -68,107 +218,229 @@ class WebCrawler:
         content_type = headers.get('Content-Type', '')
         return 'text/html' in content_type
 
+    def get_charset(self, headers):
+        """
+        Get the charset declared in the Content-Type header.
+        :param headers: The HTTP response headers.
+        :return: The declared charset, or None if the header does not declare one.
+        """
+        content_type = headers.get('Content-Type', '')
+        _, _, charset = content_type.lower().partition('charset=')      # Parameter names are case-insensitive
+        return charset.split(';')[0].strip(' "\'') or None
+
+    def get_meta_charset(self, content):
+        """
+        Get the charset declared by a <meta> tag, looking only at the start of the page like browsers do.
+        :param content: The raw page content.
+        :return: The declared charset, or None if the page does not declare one.
+        """
+        match = META_CHARSET_RE.search(content, 0, 1024)
+        return match[1].decode('ascii').lower() if match else None
+
     def get_links(self, html_content, base_url):
         """
         Extract all valid links from the HTML content, stripping fragment identifiers.
-        :param html_content: The HTML content of the page.
+        Parses in the current process - with parse_workers, crawl() submits extract_links to the worker processes
+        directly instead, since a bound method would have to pickle the whole crawler.
+        :param html_content: The HTML content of the page (str or raw bytes).
         :param base_url: The base URL to resolve relative links.
-        :return: A list of absolute URLs extracted from the page.
-        """
-        soup = BeautifulSoup(html_content, 'html.parser')
-        links = []
-        for link_tag in soup.find_all('a', href=True):          # Iterate over all <a> tags with 'href' attributes
-            href = link_tag['href'].strip()
-            if not href or href.startswith(('javascript:', 'mailto:', 'tel:', 'ftp:')):
-                continue
-            try:
-                full_url = urljoin(base_url, href)      # Resolve relative links - (only path without the domain)
-                fixed_url = self.fix_url(full_url)      # Use fix_url to validate and fix the URL
-                if not fixed_url:
-                    continue    # Skip invalid URLs
-                # Remove fragment identifiers
-                parsed_url = urlparse(fixed_url)
-                parsed_url = parsed_url._replace(fragment='')
-                full_url = parsed_url.geturl()      # Reconstruct the URL without the fragment
-                links.append(full_url)
-            except Exception as e:
-                logging.error(f"Invalid URL '{href}' found on page '{base_url}': {e}")
-                continue
-        return links
+        :return: A list of (absolute URL, hostname) tuples for the links extracted from the page.
+        """
+        return extract_links(html_content, base_url, self.fast_parse)
 
     def calculate_ratio(self, links, page_hostname):
         """
         Calculate the ratio of same-domain links on a page.
-        :param links: A list of URLs extracted from the page.
+        :param links: A list of (URL, hostname) tuples extracted from the page.
         :param page_hostname: The hostname of the current page.
         :return: The ratio of same-domain links (between 0 and 1).
         """
         total_links = len(links)
         if total_links == 0:
             return 0.0
-        same_domain_links = sum(1 for link in links if urlparse(link).hostname == page_hostname)
+        same_domain_links = sum(1 for _, hostname in links if hostname == page_hostname)
         ratio = same_domain_links / total_links
         return round(ratio, 2)
 
     def crawl(self):
         """
         Start the crawling process after fixing the root URL.
+        Pages are crawled breadth-first, one depth level at a time, and the pages of each level are fetched concurrently.
+        With parse_workers, pages are parsed in worker processes, so the calling script needs an
+        `if __name__ == '__main__':` guard.
         """
         # Remove fragment identifiers from the root URL
-        parsed_url = urlparse(self.root_url)
-        self.root_url = parsed_url._replace(fragment='').geturl()
+        self.root_url = FRAGMENT_RE.sub('', self.root_url)
+
+        parser = None
+        if self.parse_workers:
+            parser = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=PARSE_CONTEXT, initializer=setup_logging)
 
-        with requests.Session() as self.session:        # Create a session for HTTP requests
-            self._crawl(self.root_url, 1)
+        with self.session, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                parser if parser is not None else nullcontext():    # Threads for HTTP requests, optional processes for parsing
+            frontier = [self.root_url]
+            depth = 1
+            while frontier:
+                # Skip URLs visited while processing the previous level
+                frontier = [url for url in frontier if url not in self.visited_urls]
+                # Responses come back in frontier order, so pages are processed (and recorded) deterministically.
+                # With parse workers, each new page is handed to one right away, while the rest of the level is still being fetched.
+                parsed_pages = []
+                for response in self._fetch_level(executor, frontier, depth):
+                    page = self._process_page(response)
+                    if page is not None:
+                        current_url, html_content = page
+                        if parser is not None:
+                            links = parser.submit(extract_links, html_content, current_url, self.fast_parse)
+                        else:
+                            links = self.get_links(html_content, current_url)
+                        parsed_pages.append((current_url, links))
+
+                next_frontier = {}      # Used as an ordered set - each URL is enqueued once, in the order it was found
+                for current_url, links in parsed_pages:
+                    if parser is not None:
+                        links = links.result()
+                    self._record_page(current_url, links, depth)
+                    if depth < self.max_depth:      # Only enqueue links that are still within the depth limit
+                        page_links = dict.fromkeys(link for link, _ in links)     # Pages often repeat links (nav bars, footers)
+                        next_frontier.update((link, None) for link in page_links if link not in self.visited_urls)
+                frontier = list(next_frontier)
+                depth += 1
 
         self.save_results()
 
-    def _crawl(self, current_url, depth):
+    def _fetch_level(self, executor, frontier, depth):
+        """
+        Fetch the URLs of a depth level concurrently, yielding the responses in frontier order.
+        At most 2 * max_workers requests are queued or waiting to be consumed at a time, so one slow URL can't
+        make the downloaded pages of the rest of a large level pile up in memory.
+        :param executor: The thread pool to fetch with.
+        :param frontier: The URLs of the level.
+        :param depth: The current depth level in the crawling process.
+        :return: A generator of the HTTP responses (None for failed requests), in frontier order.
+        """
+        urls = iter(frontier)
+        pending = deque(executor.submit(self._fetch, url, depth) for url in islice(urls, 2 * self.max_workers))
+        while pending:
+            response = pending.popleft().result()
+            for url in islice(urls, 1):     # Keep the window full
+                pending.append(executor.submit(self._fetch, url, depth))
+            yield response
+
+    def can_fetch(self, url):
+        """
+        Check whether the robots.txt of the URL's host allows crawling it. Each robots.txt is fetched once and cached.
+        :param url: The URL to check.
+        :return: True if the URL may be crawled, False otherwise.
+        """
+        parsed = parse_url(url)
+        robots_url = f"{parsed.scheme}://{parsed.netloc}/robots.txt"
+        with self.robots_locks.setdefault(robots_url, threading.Lock()):
+            parser = self.robots_parsers.get(robots_url)
+            if parser is None:
+                parser = RobotFileParser(robots_url)
+                try:
+                    response = self.session.get(robots_url, timeout=10, headers={'Accept': 'text/plain'})
+                    response.raise_for_status()
+                    parser.parse(response.text.splitlines())
+                except requests.HTTPError as e:
+                    # RFC 9309: a missing robots.txt (4xx) allows everything, except that 401/403 are treated as
+                    # access errors, like RobotFileParser.read() does. A server error (5xx) disallows everything.
+                    status_code = e.response.status_code
+                    if status_code in (401, 403) or status_code >= 500:
+                        parser.disallow_all = True
+                    else:
+                        parser.allow_all = True
+                except requests.RequestException:
+                    # RFC 9309: an unreachable robots.txt (5xx after retries, connection errors, timeouts)
+                    # disallows everything
+                    parser.disallow_all = True
+                self.robots_parsers[robots_url] = parser
+        return parser.can_fetch(self.session.headers['User-Agent'], url)
+
+    def _fetch(self, current_url, depth):
         """
-        Recursively crawl web pages starting from the current URL.
-        :param current_url: The URL of the page to crawl.
+        Fetch a single page. Called from the worker threads, so it must not modify the crawl state (visited URLs and results).
+        :param current_url: The URL of the page to fetch.
         :param depth: The current depth level in the crawling process.
+        :return: The HTTP response, or None if the request failed or is disallowed by robots.txt.
         """
-        if depth > self.max_depth or current_url in self.visited_urls:
-            return
+        if self.respect_robots and not self.can_fetch(current_url):
+            logging.info(f"Disallowed by robots.txt: {current_url}, skipping.")
+            return None
 
         logging.info(f"Crawling URL: {current_url} at depth {depth}")
 
+        host = parse_url(current_url).netloc
+        semaphore = self.host_semaphores.setdefault(host, threading.Semaphore(MAX_CONNECTIONS_PER_HOST))
         try:
-            response = self.session.get(current_url, timeout=10)
-            response.raise_for_status()
-            current_url = response.url      # Update URL in case of redirects
+            with semaphore:
+                # Stream the response so the body is only downloaded once the headers show it is HTML
+                response = self.session.get(current_url, timeout=10, stream=True)
+                response.raise_for_status()
+                if not self.is_html(response.headers):
+                    response.close()        # Release the connection without reading the body
+                    return response
+                response.content        # Read the body here, in the worker thread
         except requests.RequestException as e:
+            if e.response is not None:
+                e.response.close()
             logging.error(f"Failed to fetch {current_url}: {e}")
-            return
+            return None
+        return response
+
+    def _process_page(self, response):
+        """
+        Check whether a fetched page is a new HTML page, and prepare its content for parsing.
+        :param response: The HTTP response of the page, or None if fetching it failed.
+        :return: A (final URL, HTML content) tuple, or None if the page should not be processed.
+        """
+        if response is None:
+            return None
+        current_url = response.url      # Use the final URL in case of redirects
 
-        # Check if the final current_url has been visited
-        if current_url in self.visited_urls:
-            return
+        # Mark the final current_url as visited - if the set didn't grow, it had been visited already
+        visited_count = len(self.visited_urls)
         self.visited_urls.add(current_url)
+        if len(self.visited_urls) == visited_count:
+            return None
 
         if not self.is_html(response.headers):
             logging.info(f"Non-HTML content at {current_url}, skipping.")
-            return
+            return None
 
-        # Compute the hash of the page content
-        content_hash = hashlib.sha256(response.text.encode('utf-8')).hexdigest()
+        # Compute the hash of the raw page content (no need to decode it first)
+        content_hash = content_digest(response.content)
 
         # Check if the content has been processed before
         if content_hash in self.visited_hashes:
             logging.info(f"Duplicate content at {current_url}, skipping processing.")
-            return
+            return None
 
         self.visited_hashes.add(content_hash)
 
-        page_hostname = urlparse(current_url).hostname
-        links = self.get_links(response.text, current_url)
-        ratio = self.calculate_ratio(links, page_hostname)
-
-        self.results.append({'url': current_url, 'depth': depth, 'ratio': ratio})
+        # The parser reads raw bytes as UTF-8 and ignores <meta charset>, so decode pages declaring another
+        # charset, in the Content-Type header or else in the page itself
+        html_content = response.content
+        charset = self.get_charset(response.headers) or self.get_meta_charset(html_content)
+        if charset and charset.lower() not in ('utf-8', 'utf8'):
+            try:
+                html_content = html_content.decode(charset, errors='replace')
+            except LookupError:
+                logging.error(f"Unknown charset '{charset}' at {current_url}, parsing as UTF-8.")
+        return current_url, html_content
 
-        for link in links:
-            self._crawl(link, depth + 1)
+    def _record_page(self, current_url, links, depth):
+        """
+        Record the result of a crawled page.
+        :param current_url: The final URL of the page.
+        :param links: A list of (absolute URL, hostname) tuples extracted from the page.
+        :param depth: The depth level the page was found at.
+        """
+        page_hostname = parse_url(current_url).hostname
+        ratio = self.calculate_ratio(links, page_hostname)
+        self.results[current_url] = {'url': current_url, 'depth': depth, 'ratio': ratio}
 
     def save_results(self):
         """
@@ -177,11 +449,9 @@ class WebCrawler:
         filename = 'output.tsv'
         if len(self.results) > 0:
             logging.info(f"Saving results to {filename}")
-            # Ensure each URL appears exactly once in the output
-            unique_results = {result['url']: result for result in self.results}     # {url: {'url':url, 'depth':depth, 'ratio':ratio}}
-            with open(filename, 'w', newline='', encoding='utf-8') as tsvfile:
-                fieldnames = ['url', 'depth', 'ratio']
-                writer = csv.DictWriter(tsvfile, fieldnames=fieldnames, delimiter='\t')
-                writer.writeheader()
-                for result in unique_results.values():
-                    writer.writerow(result)
\ No newline at end of file
+            # Rows are written directly instead of through csv. Only the URL can need quoting, and csv's
+            # quoting and '\r\n' line terminator are kept, so the output file is the same
+            with open(filename, 'w', newline='', encoding='utf-8', buffering=1 << 20) as tsvfile:
+                tsvfile.write('url\tdepth\tratio\r\n')
+                tsvfile.writelines(f"{quote_tsv_field(result['url'])}\t{result['depth']}\t{result['ratio']}\r\n"
+                                   for result in self.results.values())
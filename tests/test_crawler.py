@@ -1,8 +1,13 @@
 # tests/test_crawler.py
 
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, PropertyMock
 from crawler import WebCrawler
+from crawler.crawler import MAX_CONNECTIONS_PER_HOST
 import unittest
+import threading
+import time
+import tempfile
+import os
 import requests
 
 
@@ -11,7 +16,7 @@ class TestWebCrawler(unittest.TestCase):
         """Set up common variables and initialize the WebCrawler instance."""
         self.root_url = 'http://www.example.com'
         self.max_depth = 2
-        self.crawler = WebCrawler(self.root_url, self.max_depth)
+        self.crawler = WebCrawler(self.root_url, self.max_depth, respect_robots=False)
 
     @patch('crawler.crawler.requests.Session.get')
     def test_link_extraction_with_various_schemes(self, mock_get):
@@ -27,19 +32,23 @@ class TestWebCrawler(unittest.TestCase):
                     <a href="mailto:someone@example.com">Mailto Link</a>
                     <a href="tel:+1234567890">Tel Link</a>
                     <a href="ftp://ftp.example.com/file.txt">FTP Link</a>
+                    <a href="data:text/plain,hello">Data Link</a>
+                    <a href="JavaScript:void(0);">Uppercase JavaScript Link</a>
+                    <a href="about">Relative Link Named Like A Scheme</a>
                 </body>
             </html>
         '''
         # Mock the HTTP response
         mock_response = Mock()
-        mock_response.text = html_content
+        mock_response.content = html_content.encode('utf-8')
         mock_response.headers = {'Content-Type': 'text/html'}
         mock_get.return_value = mock_response
 
         links = self.crawler.get_links(html_content, self.root_url)
         expected_links = [
-            'http://www.example.com/page1',
-            'https://www.example.com/page2'
+            ('http://www.example.com/page1', 'www.example.com'),
+            ('https://www.example.com/page2', 'www.example.com'),
+            ('http://www.example.com/about', 'www.example.com')
         ]
         self.assertEqual(links, expected_links)
 
@@ -58,9 +67,9 @@ class TestWebCrawler(unittest.TestCase):
         '''
         base_url = 'http://www.example.com/dir/page.html'
         expected_links = [
-            'http://www.example.com/relative/path',
-            'http://www.example.com/dir/subdir/page.html',
-            'http://www.example.com/absolute/page'
+            ('http://www.example.com/relative/path', 'www.example.com'),
+            ('http://www.example.com/dir/subdir/page.html', 'www.example.com'),
+            ('http://www.example.com/absolute/page', 'www.example.com')
         ]
         links = self.crawler.get_links(html_content, base_url)
         self.assertEqual(links, expected_links)
@@ -73,7 +82,7 @@ class TestWebCrawler(unittest.TestCase):
         html_content = '<html><body><p>Same Content</p></body></html>'
         # Mock the HTTP response
         mock_response = Mock()
-        mock_response.text = html_content
+        mock_response.content = html_content.encode('utf-8')
         mock_response.headers = {'Content-Type': 'text/html'}
         mock_response.url = 'http://www.example.com'  # Set the URL attribute
         mock_get.return_value = mock_response
@@ -88,18 +97,18 @@ class TestWebCrawler(unittest.TestCase):
         Test that the crawler correctly handles HTTP redirects.
         """
 
-        def side_effect(url, timeout):
+        def side_effect(url, timeout, stream):
             if url == 'http://www.example.com':
                 # Simulate a redirect to another URL
                 mock_response = Mock()
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = '<a href="http://www.example.com/page">Page</a>'
+                mock_response.content = b'<a href="http://www.example.com/page">Page</a>'
                 mock_response.url = 'http://www.example.com/home'
                 return mock_response
             else:
                 mock_response = Mock()
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = ''
+                mock_response.content = b''
                 mock_response.url = url
                 return mock_response
 
@@ -108,10 +117,123 @@ class TestWebCrawler(unittest.TestCase):
         self.crawler.crawl()  # The crawler makes a request to 'http://www.example.com' and redirected to 'http://www.example.com/home'
                               # which contains a link to 'http://www.example.com/page'
 
-        crawled_urls = [result['url'] for result in self.crawler.results]
+        crawled_urls = [result['url'] for result in self.crawler.results.values()]
         expected_urls = ['http://www.example.com/home', 'http://www.example.com/page']
         self.assertEqual(crawled_urls, expected_urls)
 
+    @patch('crawler.crawler.requests.Session.get')
+    def test_parse_workers(self, mock_get):
+        """
+        Test that crawling with parse worker processes gives the same results as parsing in-process.
+        """
+
+        def side_effect(url, timeout, stream):
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = b'<a href="/page1">Page 1</a><a href="http://other.com/">Other</a>'
+            else:
+                mock_response.content = url.encode('utf-8')        # Distinct content, so no page is a duplicate
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        crawler = WebCrawler(self.root_url, self.max_depth, respect_robots=False, parse_workers=2)
+        crawler.crawl()
+        self.crawler.crawl()
+        self.assertEqual(list(crawler.results.values()), list(self.crawler.results.values()))
+        self.assertEqual(list(crawler.results), ['http://www.example.com', 'http://www.example.com/page1',
+                                                 'http://other.com/'])
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_duplicate_links_fetched_once(self, mock_get):
+        """
+        Test that a URL linked several times on the same depth level is only fetched once.
+        """
+
+        def side_effect(url, timeout, stream):
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = b'<a href="/page">Page</a><a href="/page">Page again</a>'
+            else:
+                mock_response.content = b''
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        self.crawler.crawl()
+        fetched_urls = [call.args[0] for call in mock_get.call_args_list]
+        self.assertEqual(fetched_urls, ['http://www.example.com', 'http://www.example.com/page'])
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_depth_limit_enforcement(self, mock_get):
+        """
+        Test that links found at the maximum depth are not crawled.
+        """
+
+        def side_effect(url, timeout, stream):
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = b'<a href="/level2">Level 2</a>'
+            else:
+                mock_response.content = b'<a href="/level3">Level 3</a>'
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        self.crawler.crawl()
+        fetched_urls = [call.args[0] for call in mock_get.call_args_list]
+        self.assertEqual(fetched_urls, ['http://www.example.com', 'http://www.example.com/level2'])
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_declared_charset_handling(self, mock_get):
+        """
+        Test that pages declaring a non UTF-8 charset in their Content-Type are decoded with it.
+        """
+
+        def side_effect(url, timeout, stream):
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html; charset=ISO-8859-1'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = '<a href="/caf\xe9">Caf\xe9</a>'.encode('iso-8859-1')
+            else:
+                mock_response.content = b''
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        self.crawler.crawl()
+        crawled_urls = [result['url'] for result in self.crawler.results.values()]
+        self.assertEqual(crawled_urls, ['http://www.example.com', 'http://www.example.com/caf\xe9'])
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_meta_charset_handling(self, mock_get):
+        """
+        Test that pages declaring their charset only in a <meta> tag are decoded with it.
+        """
+
+        def side_effect(url, timeout, stream):
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = '<meta charset="windows-1252"><a href="/caf\xe9">Caf\xe9</a>'.encode('cp1252')
+            else:
+                mock_response.content = b''
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        self.crawler.crawl()
+        crawled_urls = [result['url'] for result in self.crawler.results.values()]
+        self.assertEqual(crawled_urls, ['http://www.example.com', 'http://www.example.com/caf\xe9'])
+
     def test_fragment_identifier_handling(self):
         """
         Test that the crawler handles URLs with fragment identifiers appropriately.
@@ -128,9 +250,9 @@ class TestWebCrawler(unittest.TestCase):
         base_url = 'http://www.example.com'
         links = self.crawler.get_links(html_content, base_url)
         expected_links = [
-            'http://www.example.com/page',
-            'http://www.example.com/page',
-            'http://www.example.com/page'
+            ('http://www.example.com/page', 'www.example.com'),
+            ('http://www.example.com/page', 'www.example.com'),
+            ('http://www.example.com/page', 'www.example.com')
         ]
         self.assertEqual(links, expected_links)
 
@@ -140,20 +262,20 @@ class TestWebCrawler(unittest.TestCase):
         Test that the crawler skips non-HTML resources.
         """
 
-        def side_effect(url, timeout):
+        def side_effect(url, timeout, stream):
             mock_response = Mock()
             if url == self.root_url:
                 # Return the initial HTML content with links
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = html_content
+                mock_response.content = html_content.encode('utf-8')
                 mock_response.url = url
             elif url.endswith('.html'):
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = ''
+                mock_response.content = b''
                 mock_response.url = url
             else:
                 mock_response.headers = {'Content-Type': 'application/pdf'}
-                mock_response.text = ''
+                mock_response.content = b''
                 mock_response.url = url
             return mock_response
 
@@ -170,29 +292,163 @@ class TestWebCrawler(unittest.TestCase):
             </html>
         '''
         mock_response = Mock()
-        mock_response.text = html_content
+        mock_response.content = html_content.encode('utf-8')
         mock_response.headers = {'Content-Type': 'text/html'}
         mock_get.return_value = mock_response
 
         self.crawler.crawl()
         # Only the HTML page should be processed
-        crawled_urls = [result['url'] for result in self.crawler.results]
+        crawled_urls = [result['url'] for result in self.crawler.results.values()]
         expected_urls = ['http://www.example.com', 'http://www.example.com/page.html']
         self.assertEqual(crawled_urls, expected_urls)
 
+    @patch('crawler.crawler.requests.Session.get')
+    def test_non_html_body_not_downloaded(self, mock_get):
+        """
+        Test that the body of a non-HTML resource is never read.
+        """
+        mock_response = Mock()
+        mock_response.headers = {'Content-Type': 'application/pdf'}
+        mock_response.url = self.root_url
+        mock_content = PropertyMock(return_value=b'%PDF-1.7')
+        type(mock_response).content = mock_content
+        mock_get.return_value = mock_response
+
+        self.crawler.crawl()
+        mock_response.close.assert_called_once()
+        mock_content.assert_not_called()
+        self.assertEqual(len(self.crawler.results), 0)
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_fetch_window_is_bounded(self, mock_get):
+        """
+        Test that a slow URL doesn't let the rest of its level be fetched ahead without bound.
+        """
+        crawler = WebCrawler(self.root_url, self.max_depth, max_workers=2, respect_robots=False)
+        started_while_slow = []
+
+        def side_effect(url, timeout, stream):
+            if url == 'http://www.example.com/page0':
+                time.sleep(0.2)     # Let the other workers run ahead as far as they can
+                started_while_slow.append(mock_get.call_count)
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = ''.join(f'<a href="/page{i}">Page {i}</a>' for i in range(10)).encode('utf-8')
+            else:
+                mock_response.content = url.encode('utf-8')        # Distinct content, so no page is a duplicate
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        crawler.crawl()
+        self.assertEqual(len(crawler.results), 11)
+        # The root page plus a window of 2 * max_workers pages of the second level
+        self.assertEqual(started_while_slow, [1 + 2 * 2])
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_per_host_connection_limit(self, mock_get):
+        """
+        Test that no more than MAX_CONNECTIONS_PER_HOST requests to the same host are in flight at once.
+        """
+        lock = threading.Lock()
+        in_flight = {'current': 0, 'max': 0}
+
+        def side_effect(url, timeout, stream):
+            with lock:
+                in_flight['current'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['current'])
+            time.sleep(0.05)        # Keep the request open so the other workers pile up
+            with lock:
+                in_flight['current'] -= 1
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == self.root_url:
+                mock_response.content = ''.join(f'<a href="/page{i}">Page {i}</a>' for i in range(12)).encode('utf-8')
+            else:
+                mock_response.content = url.encode('utf-8')        # Distinct content, so no page is a duplicate
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        self.crawler.crawl()
+        self.assertEqual(len(self.crawler.results), 13)
+        self.assertEqual(in_flight['max'], MAX_CONNECTIONS_PER_HOST)
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_robots_txt_handling(self, mock_get):
+        """
+        Test that URLs disallowed by robots.txt are not crawled, and that robots.txt is fetched once per host.
+        """
+        crawler = WebCrawler(self.root_url, self.max_depth)
+
+        def side_effect(url, timeout, stream=False, headers=None):
+            mock_response = Mock()
+            mock_response.headers = {'Content-Type': 'text/html'}
+            mock_response.url = url
+            if url == 'http://www.example.com/robots.txt':
+                mock_response.text = 'User-agent: *\nDisallow: /private'
+            elif url == self.root_url:
+                mock_response.content = b'<a href="/private/page">Private</a><a href="/public">Public</a>'
+            else:
+                mock_response.content = b''
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        crawler.crawl()
+        fetched_urls = [call.args[0] for call in mock_get.call_args_list]
+        self.assertEqual(fetched_urls.count('http://www.example.com/robots.txt'), 1)
+        self.assertNotIn('http://www.example.com/private/page', fetched_urls)
+        crawled_urls = [result['url'] for result in crawler.results.values()]
+        self.assertEqual(crawled_urls, ['http://www.example.com', 'http://www.example.com/public'])
+
+    @patch('crawler.crawler.requests.Session.get')
+    def test_robots_txt_server_error(self, mock_get):
+        """
+        Test that nothing is crawled when robots.txt returns a server error or is unreachable.
+        """
+        robots_errors = [
+            requests.HTTPError(response=Mock(status_code=503)),
+            requests.exceptions.RetryError("Max retries exceeded"),     # What the retrying adapter raises on 5xx
+            requests.ConnectionError("Connection refused")
+        ]
+        for robots_error in robots_errors:
+            with self.subTest(robots_error=robots_error):
+                crawler = WebCrawler(self.root_url, self.max_depth)
+                mock_get.reset_mock()
+
+                def side_effect(url, timeout, stream=False, headers=None):
+                    if url == 'http://www.example.com/robots.txt':
+                        raise robots_error
+                    mock_response = Mock()
+                    mock_response.headers = {'Content-Type': 'text/html'}
+                    mock_response.url = url
+                    mock_response.content = b'<a href="/page">Page</a>'
+                    return mock_response
+
+                mock_get.side_effect = side_effect
+
+                crawler.crawl()
+                fetched_urls = [call.args[0] for call in mock_get.call_args_list]
+                self.assertEqual(fetched_urls, ['http://www.example.com/robots.txt'])
+                self.assertEqual(len(crawler.results), 0)
+
     @patch('crawler.crawler.requests.Session.get')
     def test_error_handling_and_timeouts(self, mock_get):
         """
         Test that the crawler handles exceptions and timeouts gracefully.
         """
 
-        def side_effect(url, timeout):
+        def side_effect(url, timeout, stream):
             if url == 'http://www.example.com':
                 raise requests.RequestException("Connection error")
             else:
                 mock_response = Mock()
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = ''
+                mock_response.content = b''
                 return mock_response
 
         mock_get.side_effect = side_effect
@@ -207,10 +463,10 @@ class TestWebCrawler(unittest.TestCase):
         """
         page_hostname = 'www.example.com'
         links = [
-            'http://www.example.com/page1',
-            'http://www.example.com/page2',
-            'http://otherdomain.com/page',
-            'http://anotherdomain.com/page'
+            ('http://www.example.com/page1', 'www.example.com'),
+            ('http://www.example.com/page2', 'www.example.com'),
+            ('http://otherdomain.com/page', 'otherdomain.com'),
+            ('http://anotherdomain.com/page', 'anotherdomain.com')
         ]
         ratio = self.crawler.calculate_ratio(links, page_hostname)
         expected_ratio = 0.5
@@ -220,7 +476,7 @@ class TestWebCrawler(unittest.TestCase):
         """
         Test that fix_url correctly handles URLs missing the scheme.
         """
-        with patch('crawler.crawler.requests.head') as mock_head:
+        with patch('crawler.crawler.requests.Session.head') as mock_head:
             # Simulate that http:// works
             mock_response = Mock()
             mock_response.status_code = 200
@@ -247,17 +503,17 @@ class TestWebCrawler(unittest.TestCase):
             </html>
         '''
 
-        def side_effect(url, timeout):
+        def side_effect(url, timeout, stream):
             mock_response = Mock()
             if url == self.crawler.root_url:
                 # Return the initial HTML content with links
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = html_content
+                mock_response.content = html_content.encode('utf-8')
                 mock_response.url = url
             elif url == 'http://www.example.com/valid':
                 # Return a valid page
                 mock_response.headers = {'Content-Type': 'text/html'}
-                mock_response.text = '<html><body>Valid Page Content</body></html>'
+                mock_response.content = b'<html><body>Valid Page Content</body></html>'
                 mock_response.url = url
             else:
                 # Simulate an invalid URL by raising an exception
@@ -269,7 +525,7 @@ class TestWebCrawler(unittest.TestCase):
 
         self.crawler.crawl()
         # Only the valid URL should be processed
-        crawled_urls = [result['url'] for result in self.crawler.results]
+        crawled_urls = [result['url'] for result in self.crawler.results.values()]
         expected_urls = ['http://www.example.com', 'http://www.example.com/valid']
         self.assertEqual(crawled_urls, expected_urls)
 
@@ -277,7 +533,7 @@ class TestWebCrawler(unittest.TestCase):
         """
         Unit test for fix_url function with various inputs.
         """
-        with patch('crawler.crawler.requests.head') as mock_head:
+        with patch('crawler.crawler.requests.Session.head') as mock_head:
             # Case where http works
             mock_response_http = Mock()
             mock_response_http.status_code = 200
@@ -297,19 +553,75 @@ class TestWebCrawler(unittest.TestCase):
             fixed_url = self.crawler.fix_url('example.com')
             self.assertEqual(fixed_url, 'https://example.com')
 
+    def test_save_results_quoting(self):
+        """
+        Test that save_results quotes URLs containing quotes, the same way csv.DictWriter did.
+        """
+        self.crawler.results = {
+            'http://www.example.com/a"b': {'url': 'http://www.example.com/a"b', 'depth': 1, 'ratio': 0.5},
+            'http://www.example.com/c': {'url': 'http://www.example.com/c', 'depth': 2, 'ratio': 1.0}
+        }
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                self.crawler.save_results()
+                with open('output.tsv', newline='', encoding='utf-8') as tsvfile:
+                    output = tsvfile.read()
+            finally:
+                os.chdir(cwd)
+        expected_output = ('url\tdepth\tratio\r\n'
+                           '"http://www.example.com/a""b"\t1\t0.5\r\n'
+                           'http://www.example.com/c\t2\t1.0\r\n')
+        self.assertEqual(output, expected_output)
+
+    def test_unit_get_charset(self):
+        """
+        Unit test for get_charset function with different Content-Type headers.
+        """
+        self.assertEqual(self.crawler.get_charset({'Content-Type': 'text/html; charset=UTF-8'}), 'utf-8')
+        self.assertEqual(self.crawler.get_charset({'Content-Type': 'text/html; Charset="ISO-8859-1"'}), 'iso-8859-1')
+        self.assertIsNone(self.crawler.get_charset({'Content-Type': 'text/html'}))
+
     def test_unit_calculate_ratio(self):
         """
         Unit test for calculate_ratio function with predefined links.
         """
         links = [
-            'http://www.example.com/page1',
-            'http://www.example.com/page2',
-            'http://otherdomain.com/page',
+            ('http://www.example.com/page1', 'www.example.com'),
+            ('http://www.example.com/page2', 'www.example.com'),
+            ('http://otherdomain.com/page', 'otherdomain.com'),
         ]
         page_hostname = 'www.example.com'
         ratio = self.crawler.calculate_ratio(links, page_hostname)
         self.assertEqual(ratio, 0.67)  # Rounded to two decimal places
 
+    def test_fast_parse_get_links(self):
+        """
+        Test that the fast_parse mode extracts the same links as the HTML parser.
+        """
+        fast_crawler = WebCrawler(self.root_url, self.max_depth, respect_robots=False, fast_parse=True)
+        html_content = b'''
+            <html>
+                <body>
+                    <A HREF="/page1?a=1&amp;b=2">Uppercase Tag With Entity</A>
+                    <a data-href="/ignored" href='/page2'>Single Quotes</a>
+                    <a class=link href=/page3>Unquoted</a>
+                    <a href="#section">Anchor Link</a>
+                    <a href="javascript:void(0);">JavaScript Link</a>
+                </body>
+            </html>
+        '''
+        base_url = 'http://www.example.com'
+        expected_links = [
+            ('http://www.example.com/page1?a=1&b=2', 'www.example.com'),
+            ('http://www.example.com/page2', 'www.example.com'),
+            ('http://www.example.com/page3', 'www.example.com'),
+            ('http://www.example.com', 'www.example.com')
+        ]
+        self.assertEqual(fast_crawler.get_links(html_content, base_url), expected_links)
+        self.assertEqual(self.crawler.get_links(html_content, base_url), expected_links)
+
     def test_unit_get_links(self):
         """
         Unit test for get_links function with different HTML content.
@@ -327,9 +639,9 @@ class TestWebCrawler(unittest.TestCase):
         base_url = 'http://www.example.com'
         links = self.crawler.get_links(html_content, base_url)
         expected_links = [
-            'http://www.example.com/page1',
-            'http://www.example.com/page2',
-            'http://www.example.com'  # Anchor link should resolve to base URL without fragment
+            ('http://www.example.com/page1', 'www.example.com'),
+            ('http://www.example.com/page2', 'www.example.com'),
+            ('http://www.example.com', 'www.example.com')  # Anchor link should resolve to base URL without fragment
         ]
         self.assertEqual(links, expected_links)
 